@@ -0,0 +1,82 @@
+"""
+Micro-benchmark for extracting the city fields from saved city-data.com pages.
+
+Compares the original extraction (full parse, raw XPath strings, untyped values) with
+CityPageExtractor (compiled XPaths, relevant sections only, typed values), and with the
+extractor run on the full page so the gain of cutting the page is shown separately.
+
+By default it uses benchmarks/fixtures/city_page.html, a hand-written page that follows the
+city-data.com layout with every field section near the top. It is not a recording, so its
+timings are synthetic and favour the cut. For representative numbers pass directories of
+city pages saved from city-data.com. Run from the repository root:
+
+python benchmarks/bench_city_extract.py [directory ...]
+"""
+
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lxml import html
+import market_research as mr
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+REPEAT = 50
+
+# The original scrape_city_data extraction
+def extract_original(content, fields):
+    tree = html.fromstring(content)
+    data = {}
+    for field_name, field_xpath in fields.items():
+        elements = tree.xpath(field_xpath)
+        data[field_name] = mr.to_auto(elements[0]) if elements else None
+    return data
+
+def time_per_page(function, pages):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        for content in pages:
+            function(content)
+    return (time.perf_counter() - start) / (REPEAT * len(pages))
+
+def main(directories):
+    paths = [path for directory in directories or [FIXTURES_DIR] for path in sorted(glob.glob(os.path.join(directory, 'city*.html')))]
+    if not paths:
+        print("No city pages found")
+        return 1
+    pages = []
+    for path in paths:
+        with open(path, 'rb') as page_file:
+            pages.append(page_file.read())
+
+    extractor = mr.CityPageExtractor(mr.city_fields, mr.city_field_types)
+    parser = extractor.parser
+
+    original_seconds = time_per_page(lambda content: extract_original(content, mr.city_fields), pages)
+    parse_seconds = time_per_page(lambda content: html.fromstring(extractor.get_relevant_content(content), parser=parser), pages)
+    extract_seconds = time_per_page(extractor.extract, pages)
+    full_page_seconds = time_per_page(lambda content: extractor.extract_tree(html.fromstring(content, parser=parser)), pages)
+
+    print(f"Pages: {len(pages)}, average size: {sum(len(content) for content in pages) / len(pages) / 1024:.0f} KB")
+    if not directories:
+        print("Synthetic fixture page, pass directories of saved city-data.com pages for real timings")
+    print(f"Original parse + extract:  {original_seconds * 1000:.3f} ms/page")
+    print(f"Extractor on full page:    {full_page_seconds * 1000:.3f} ms/page ({original_seconds / full_page_seconds:.1f}x)")
+    print(f"Extractor parse only:      {parse_seconds * 1000:.3f} ms/page")
+    print(f"Extractor parse + extract: {extract_seconds * 1000:.3f} ms/page ({original_seconds / extract_seconds:.1f}x)")
+
+    for path, content in zip(paths, pages):
+        data, missing = extractor.extract(content)
+        print(f"\n{os.path.basename(path)}")
+        for field_name, value in data.items():
+            print(f"  {field_name}: {value!r}")
+        if missing:
+            print(f"  Missing: {', '.join(missing)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
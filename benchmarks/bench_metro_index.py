@@ -0,0 +1,70 @@
+"""
+Benchmark the nearest metro area index against the original per-area geodesic loop.
+
+Runs both over every city in the geocode store, checks that they pick the same metro area
+and prints the timings. Run from the repository root:
+
+python benchmarks/bench_metro_index.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geopy.distance import geodesic
+import market_research as mr
+
+# The original find_closest_metro_area: one geodesic per metro area, in pure Python
+def closest_metro_area_loop(target_coords):
+    closest_metro_area = None
+    min_distance = float('inf')
+    for area_name, area in mr.get_area_data().items():
+        distance = geodesic(target_coords, area['coordinates']).kilometers
+        if distance < min_distance:
+            min_distance = distance
+            closest_metro_area = area_name
+    return closest_metro_area
+
+def main():
+    cities = mr.get_geocode_store().load_cities()
+    city_names = list(cities)
+    coords_list = [cities[city_name] for city_name in city_names]
+
+    start = time.perf_counter()
+    loop_results = [closest_metro_area_loop(coords) for coords in coords_list]
+    loop_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = mr.MetroAreaIndex(mr.get_geocode_store().load_area_table())
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    single_results = [index.query(coords)[0][0] for coords in coords_list]
+    single_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch_results = [nearest[0][0] for nearest in index.query_batch(coords_list)]
+    batch_seconds = time.perf_counter() - start
+
+    mismatches = [(city_name, expected, actual)
+                  for city_name, expected, actual in zip(city_names, loop_results, batch_results)
+                  if expected != actual]
+    mismatches += [(city_name, expected, actual)
+                   for city_name, expected, actual in zip(city_names, loop_results, single_results)
+                   if expected != actual]
+
+    print(f"Cities: {len(city_names)}, metro areas: {len(mr.get_area_data())}")
+    print(f"Geodesic loop:      {loop_seconds:.3f}s")
+    print(f"Index build:        {build_seconds:.3f}s")
+    print(f"Index single query: {single_seconds:.3f}s ({loop_seconds / single_seconds:.1f}x)")
+    print(f"Index batch query:  {batch_seconds:.3f}s ({loop_seconds / batch_seconds:.1f}x)")
+    print(f"Mismatches:         {len(mismatches)}")
+    for city_name, expected, actual in mismatches:
+        print(f"  {city_name}: loop={expected} index={actual}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
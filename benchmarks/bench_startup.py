@@ -0,0 +1,65 @@
+"""
+Benchmark the startup time of market_research.
+
+Every measurement runs in a fresh interpreter: importing the module, the first closest metro
+area lookup with the area table built from the geocode store, and the same lookup with the
+table memory-mapped from the .npy file written by the previous run. Run from the
+repository root:
+
+python benchmarks/bench_startup.py --runs 10
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TIMED_SCRIPT = """
+import time
+start = time.perf_counter()
+import market_research as mr
+{setup}
+imported = time.perf_counter()
+{statement}
+print(imported - start, time.perf_counter() - imported)
+"""
+
+# Close to a metro area, so the lookup doesn't need the geocoder
+LOOKUP = "mr.get_metro_index().query((33.0198, -96.6989))"
+REMOVE_AREA_TABLE = "import os\ntry:\n    os.remove(mr.get_geocode_store().area_table_path)\nexcept OSError:\n    pass"
+
+def time_script(setup='', statement='pass'):
+    script = TIMED_SCRIPT.format(setup=setup, statement=statement)
+    output = subprocess.run([sys.executable, '-c', script], cwd=REPOSITORY_DIR, check=True,
+                            capture_output=True, text=True).stdout
+    import_seconds, statement_seconds = map(float, output.split())
+    return import_seconds, statement_seconds
+
+def report(name, timings):
+    timings_ms = sorted(seconds * 1000 for seconds in timings)
+    print(f"{name:<28} median {statistics.median(timings_ms):>8.1f} ms  min {timings_ms[0]:>8.1f} ms  max {timings_ms[-1]:>8.1f} ms")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of market_research.')
+    parser.add_argument('--runs', type=int, default=10, help='Interpreters started per measurement (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    imports, built, mapped = [], [], []
+    for _ in range(args.runs):
+        import_seconds, _ = time_script()
+        imports.append(import_seconds)
+        _, lookup_seconds = time_script(setup=REMOVE_AREA_TABLE, statement=LOOKUP)
+        built.append(lookup_seconds)
+        _, lookup_seconds = time_script(statement=LOOKUP)
+        mapped.append(lookup_seconds)
+
+    report('import market_research', imports)
+    report('first lookup, table built', built)
+    report('first lookup, table mapped', mapped)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Check the BLS job data path against the local stand-in server.
+
+Covers parse_bls_series (two years of monthly data, a missing prior-year month, annual
+averages), that the timeseries page and the API give the same job data for the series in
+benchmarks/fixtures/bls_timeseries.html, and fetch_bls_series through the API, through the
+timeseries page fallback and with an unreachable page. Exits with an error when a check
+fails. Run from the repository root:
+
+python benchmarks/check_bls.py
+"""
+
+import os
+import re
+import socket
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import market_research as mr
+from standin_server import StandInServer, configure_market_research, read_fixture
+
+def monthly(year, month, value):
+    return {'year': str(year), 'period': f"M{month:02d}", 'value': value}
+
+def check_parse_bls_series():
+    two_years = {'data': [monthly(year, month, f"{1000 + year - 2024 + month / 10:,.1f}")
+                          for year in (2024, 2025) for month in range(1, 13)]}
+    assert mr.parse_bls_series(two_years) == {
+        'reference_month': '2025-12', 'most_recent_value': 1002.2, 'previous_year_value': 1001.2}
+
+    # The latest month has no value a year earlier
+    missing_prior_year = {'data': [monthly(2025, 3, '1,010.0'), monthly(2025, 2, '1,008.0'), monthly(2024, 2, '990.0')]}
+    assert mr.parse_bls_series(missing_prior_year) is None
+
+    # Annual averages (M13) and unparseable values are ignored
+    annual = {'data': [{'year': '2025', 'period': 'M13', 'value': '1,200.0'}, monthly(2025, 6, '-'),
+                       monthly(2025, 5, '1,100.0'), monthly(2024, 5, '1,000.0')]}
+    assert mr.parse_bls_series(annual) == {
+        'reference_month': '2025-05', 'most_recent_value': 1100.0, 'previous_year_value': 1000.0}
+
+    assert mr.parse_bls_series({'data': []}) is None
+
+# The table of the timeseries page fixture as the data of a BLS API series
+def get_fixture_series():
+    page = read_fixture('bls_timeseries.html').decode()
+    data = []
+    for year, cells in re.findall(r'<th id="col0" scope="row">(\d{4})</th>(.*?)</tr>', page):
+        for month, cell in enumerate(re.findall(r'<td>(.*?)</td>', cells), start=1):
+            value = re.sub(r'<[^>]+>|\(P\)', '', cell)
+            if value:
+                data.append(monthly(int(year), month, value))
+    return {'data': data}
+
+# The page parser reads the latest filled month (August of the partial last year, with its
+# preliminary footnote) and the same month a year earlier, like the API parser
+def check_page_matches_api():
+    expected = {'reference_month': '2025-08', 'most_recent_value': 1363.5, 'previous_year_value': 1352.3}
+    assert mr.parse_bls_series(get_fixture_series()) == expected
+    job_data = mr.scrape_bls_data(f"{mr.BLS_TIMESERIES_URL}{mr.construct_bls_series_id('Texas', '19100')}")
+    assert job_data == expected, job_data
+
+# A local URL nothing listens on
+def get_closed_url():
+    with socket.socket() as closed_socket:
+        closed_socket.bind(('127.0.0.1', 0))
+        port = closed_socket.getsockname()[1]
+    return f"http://127.0.0.1:{port}/"
+
+def check_fetch_bls_series(server):
+    series_ids = [mr.construct_bls_series_id('Texas', '19100'), mr.construct_bls_series_id('Ohio', '17140')]
+    api_url, timeseries_url = mr.BLS_API_URL, mr.BLS_TIMESERIES_URL
+
+    mr.bls_series_data.clear()
+    job_data = mr.fetch_bls_series(series_ids)
+    assert all(job_data[series_id]['previous_year_value'] == 1221.8 for series_id in series_ids), job_data
+
+    # The API is down, the timeseries pages are used
+    mr.bls_series_data.clear()
+    mr.BLS_API_URL = get_closed_url()
+    job_data = mr.fetch_bls_series(series_ids)
+    assert all(job_data[series_id] == mr.parse_bls_series(get_fixture_series()) for series_id in series_ids), job_data
+
+    # The API and the pages are down, the series are missing but the run goes on
+    mr.bls_series_data.clear()
+    mr.BLS_TIMESERIES_URL = get_closed_url()
+    job_data = mr.fetch_bls_series(series_ids)
+    assert job_data == {series_id: None for series_id in series_ids}, job_data
+
+    mr.BLS_API_URL, mr.BLS_TIMESERIES_URL = api_url, timeseries_url
+    mr.bls_series_data.clear()
+
+def main():
+    # Fail fast on the unreachable URLs
+    mr.MAX_RETRIES = 0
+    server = StandInServer(mr.state_initials).start()
+    configure_market_research(mr, server)
+
+    checks = [check_parse_bls_series, check_page_matches_api, lambda: check_fetch_bls_series(server)]
+    for check in checks:
+        check()
+    server.shutdown()
+    print(f"{len(checks)} BLS checks passed")
+
+
+if __name__ == "__main__":
+    main()
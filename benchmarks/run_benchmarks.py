@@ -0,0 +1,184 @@
+"""
+Offline benchmark suite for the scraper.
+
+Serves the hand-written fixture pages in benchmarks/fixtures and generated state index
+pages from a local stand-in server (see standin_server.py), so the timings are synthetic.
+Measures each stage (scrape_cities, scrape_city_data, scrape_bls_data, fetch_bls_series,
+find_closest_metro_area, save_checkpoints_to_spreadsheet) and a full end to end run at one or more
+scales (number of states). Throughput and latency percentiles are written to a JSON file.
+Run from the repository root:
+
+python benchmarks/run_benchmarks.py --scales 1 5 50 --cities-per-state 20 --output benchmark_results.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+import market_research as mr
+from standin_server import StandInServer, configure_market_research, get_city_names
+
+def summarize(latencies, wall_seconds):
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'count': len(latencies),
+        'wall_seconds': round(wall_seconds, 6),
+        'throughput_per_second': round(len(latencies) / wall_seconds, 3) if wall_seconds else None,
+        'latency_ms': {
+            'mean': round(float(latencies_ms.mean()), 3),
+            'p50': round(float(np.percentile(latencies_ms, 50)), 3),
+            'p90': round(float(np.percentile(latencies_ms, 90)), 3),
+            'p99': round(float(np.percentile(latencies_ms, 99)), 3),
+            'max': round(float(latencies_ms.max()), 3),
+        } if len(latencies) else None
+    }
+
+# Call function once per item on a pool of workers, timing every call
+def bench_stage(function, items, workers):
+    def timed(item):
+        start = time.perf_counter()
+        function(item)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        latencies = list(executor.map(timed, items))
+    return summarize(latencies, time.perf_counter() - start)
+
+# Give every synthetic city coordinates close to a metro area of its state, so no
+# geocoding requests are made
+def seed_geocode_store(store, area_data, states, cities_per_state):
+    rng = random.Random(0)
+    cities = {}
+    for state in states:
+        initials = mr.state_initials[state]
+        areas = [area['coordinates'] for area_name, area in area_data.items() if initials in mr.get_area_states(area_name)]
+        for city_name in get_city_names(state, cities_per_state):
+            latitude, longitude = rng.choice(areas) if areas else (rng.uniform(30, 48), rng.uniform(-120, -75))
+            cities[f"{city_name}, {initials}"] = (latitude + rng.uniform(-0.5, 0.5), longitude + rng.uniform(-0.5, 0.5))
+    store.put_areas(area_data)
+    store.put_cities(cities)
+
+def run_scale(server, states, args, work_dir):
+    cities_per_state = args.cities_per_state
+    cities = [(state, city_name) for state in states for city_name in get_city_names(state, cities_per_state)]
+    city_names = [f"{city_name}, {mr.state_initials[state]}" for state, city_name in cities]
+    series_ids = sorted({mr.construct_bls_series_id(state, area['area_code'])
+                         for state in states for area in list(mr.get_area_data().values())[:cities_per_state]})
+    stages = {}
+
+    stages['scrape_cities'] = bench_stage(
+        lambda state: mr.scrape_cities(f"{mr.CITY_DATA_URL}{state.replace(' ', '-')}.html", state, 0),
+        states, args.workers)
+
+    stages['scrape_city_data'] = bench_stage(
+        lambda city: mr.scrape_city_data(f"{mr.CITY_DATA_URL}{city[1].replace(' ', '-')}-{city[0].replace(' ', '-')}.html",
+                                         mr.city_fields, mr.city_field_types),
+        cities, args.workers)
+
+    stages['scrape_bls_data'] = bench_stage(
+        lambda series_id: mr.scrape_bls_data(f"{mr.BLS_TIMESERIES_URL}{series_id}"),
+        series_ids, args.workers)
+
+    def fetch_bls_batch(batch):
+        mr.bls_series_data.clear()
+        mr.fetch_bls_series(batch)
+    stages['fetch_bls_series'] = bench_stage(fetch_bls_batch, [series_ids], 1)
+
+    # CPU bound, so timed on a single thread
+    stages['find_closest_metro_area'] = bench_stage(mr.find_closest_metro_area, city_names, 1)
+
+    # The spreadsheet writer of a run, reading one state's rows from a checkpoint
+    checkpoint_path = os.path.join(work_dir, 'checkpoints', 'bench.jsonl')
+    checkpoint = mr.CheckpointWriter(checkpoint_path)
+    for state, city_name in cities[:cities_per_state]:
+        row = mr.scrape_city(city_name, state, mr.city_fields)
+        if row:
+            checkpoint.write(city_name, row)
+    checkpoint.close()
+    stages['save_checkpoints_to_spreadsheet'] = bench_stage(
+        lambda state: mr.save_checkpoints_to_spreadsheet(
+            {state: checkpoint_path}, os.path.join(work_dir, f"{mr.get_state_file_name(state)}.xlsx")),
+        states, args.workers)
+
+    mr.bls_series_data.clear()
+    start = time.perf_counter()
+    mr.main([*states, '--min-population', '0', '--workers', str(args.workers), '--output-dir', os.path.join(work_dir, 'run')])
+    end_to_end_seconds = time.perf_counter() - start
+
+    return {
+        'states': len(states),
+        'cities': len(cities),
+        'stages': stages,
+        'end_to_end': {
+            'wall_seconds': round(end_to_end_seconds, 6),
+            'cities_per_second': round(len(cities) / end_to_end_seconds, 3)
+        }
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the scraper against a local stand-in server.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 5],
+                        help='Numbers of states to run, between 1 and 50 (default: %(default)s)')
+    parser.add_argument('--cities-per-state', type=int, default=20, help='Cities in every state index (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=mr.MAX_WORKERS, help='Concurrent requests (default: %(default)s)')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Simulated server latency per request (default: %(default)s)')
+    parser.add_argument('--output', default='benchmark_results.json', help='Results file (default: %(default)s)')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    all_states = list(mr.state_initials)
+    server = StandInServer(mr.state_initials, args.cities_per_state, args.latency_ms / 1000).start()
+    configure_market_research(mr, server, args.workers)
+
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'config': {
+            'cities_per_state': args.cities_per_state,
+            'workers': args.workers,
+            'latency_ms': args.latency_ms
+        },
+        'scales': {}
+    }
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        # The metro areas come from the repository's geocode store, the synthetic cities only
+        # go to a temporary one
+        area_data = mr.get_area_data()
+        mr.geocode_store = mr.GeocodeStore(os.path.join(work_dir, 'geocode.sqlite3'))
+        for scale in args.scales:
+            states = all_states[:max(1, min(scale, len(all_states)))]
+            seed_geocode_store(mr.geocode_store, area_data, states, args.cities_per_state)
+            print(f"Benchmarking {len(states)} state(s), {len(states) * args.cities_per_state} cities")
+            with contextlib.redirect_stdout(io.StringIO()):
+                results['scales'][str(len(states))] = run_scale(server, states, args, work_dir)
+
+            for stage, summary in results['scales'][str(len(states))]['stages'].items():
+                latency = summary['latency_ms']
+                print(f"  {stage:<32} {summary['throughput_per_second']:>10.1f}/s  p50 {latency['p50']:>8.2f} ms  p99 {latency['p99']:>8.2f} ms")
+            print(f"  {'end to end':<32} {results['scales'][str(len(states))]['end_to_end']['wall_seconds']:>10.2f} s")
+
+    server.shutdown()
+    results['requests_served'] = server.request_count
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=4)
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Local HTTP stand-in for city-data.com and BLS, so the scraper can run without touching the
+network. The pages in benchmarks/fixtures are hand-written to follow the layout of the real
+sites, they are not recordings; the state index pages and API responses are generated.
+
+- GET /city/<State>.html: generated state index with cities_per_state synthetic cities
+- GET /city/<City>-<State>.html: the hand-written city page fixture
+- GET /timeseries/<series id>: the hand-written BLS timeseries page fixture
+- POST /api/: generated BLS timeseries JSON API response for the requested series
+
+Use configure_market_research() to point market_research at a running server.
+"""
+
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def read_fixture(file_name):
+    with open(os.path.join(FIXTURES_DIR, file_name), 'rb') as fixture_file:
+        return fixture_file.read()
+
+# Synthetic city names of a state, eg. "Alabama City 3"
+def get_city_names(state, cities_per_state):
+    return [f"{state} City {i}" for i in range(cities_per_state)]
+
+def build_state_page(state, state_initials, cities_per_state):
+    rows = ''.join(
+        f'<tr><td>{i + 1}.</td><td>{city_name}, {state_initials}</td><td>{200000 - i * 1000:,}</td></tr>'
+        for i, city_name in enumerate(get_city_names(state, cities_per_state))
+    )
+    return f'<html><body><table class="tabBlue"><thead><tr><th>#</th><th>Name</th><th>Population</th></tr></thead><tbody>{rows}</tbody></table></body></html>'.encode()
+
+def build_bls_api_response(series_ids, year):
+    series = [
+        {
+            'seriesID': series_id,
+            'data': [
+                {'year': str(year), 'period': 'M08', 'periodName': 'August', 'latest': 'true', 'value': '1,254.3'},
+                {'year': str(year), 'period': 'M07', 'periodName': 'July', 'value': '1,250.1'},
+                {'year': str(year - 1), 'period': 'M08', 'periodName': 'August', 'value': '1,221.8'},
+                {'year': str(year - 1), 'period': 'M07', 'periodName': 'July', 'value': '1,219.0'},
+            ]
+        }
+        for series_id in series_ids
+    ]
+    return json.dumps({'status': 'REQUEST_SUCCEEDED', 'responseTime': 12, 'message': [], 'Results': {'series': series}}).encode()
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Keep-alive responses are written in two parts, without this Nagle's algorithm adds ~40ms
+    disable_nagle_algorithm = True
+
+    def send_body(self, body, content_type='text/html; charset=utf-8', status=200):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.request_count += 1
+
+    def do_GET(self):
+        path = unquote(self.path)
+        if path.startswith('/city/') and path.endswith('.html'):
+            state = path[len('/city/'):-len('.html')].replace('-', ' ')
+            if state in self.server.state_initials:
+                return self.send_body(build_state_page(state, self.server.state_initials[state], self.server.cities_per_state))
+            return self.send_body(self.server.city_page)
+        if path.startswith('/timeseries/'):
+            return self.send_body(self.server.bls_page)
+        self.send_body(b'Not found', 'text/plain', 404)
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.send_body(build_bls_api_response(payload['seriesid'], int(payload['endyear'])), 'application/json')
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, state_initials, cities_per_state=20, latency=0.0, port=0):
+        super().__init__(('127.0.0.1', port), StandInRequestHandler)
+        self.state_initials = state_initials
+        self.cities_per_state = cities_per_state
+        self.latency = latency
+        self.city_page = read_fixture('city_page.html')
+        self.bls_page = read_fixture('bls_timeseries.html')
+        self.request_count = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+# Send all of market_research's requests to the stand-in server instead of the real sites
+def configure_market_research(mr, server, max_workers=None):
+    mr.CITY_DATA_URL = f"{server.base_url}/city/"
+    mr.BLS_TIMESERIES_URL = f"{server.base_url}/timeseries/"
+    mr.BLS_API_URL = f"{server.base_url}/api/"
+    mr.configure_fetcher(max_workers=max_workers, rate_limits={f"127.0.0.1:{server.server_port}": 100000})
+    mr.configure_cache(enabled=False)
@@ -5,28 +5,41 @@ Last Modified: 2024-07-05
 Description: This script scrapes data from city-data.com and saves it to a spreadsheet. 
 License: MIT License
 
-To use, add your Google Maps API key to line 164: 
+To use, add your Google Maps API key to create_geolocator(): 
 
-geolocator = GoogleV3(api_key='<your api key>')
+return GoogleV3(api_key='<your api key>')
 
-And add your state to line 274. eg:
+And pass the states to analyze on the command line. eg:
 
-STATES_TO_ANALYZE = {
-    'North Carolina', 'Alabama', 'Georgia'
-}
+python market_research.py "North Carolina" Alabama Georgia --min-population 50000
 
 """
 
-import requests
+import argparse
+import bisect
+import io
+import logging
+import sys
 import json
-from lxml import html
-import pandas as pd
+import gzip
+import hashlib
+import importlib.util
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import repeat
+from urllib.parse import urlparse
+from lxml import etree, html
 import re
-from datetime import datetime
-from shapely.geometry import Point
-import geopandas as gpd
-from geopy.geocoders import GoogleV3
-from geopy.distance import geodesic
+from datetime import datetime, timedelta
+
+# requests, numpy, pandas, openpyxl, geopy and cProfile are imported by the functions that use
+# them, so importing this module (eg. in every spawned worker process, or for --help) stays
+# fast and runs that never write a spreadsheet don't pay for pandas and openpyxl
 
 state_initials = {
     "Alabama": "AL", "Alaska": "AK", "Arizona": "AZ", "Arkansas": "AR", "California": "CA",
@@ -55,36 +68,570 @@ state_code_map = {
     "Virginia":"51","Washington":"53","West Virginia":"54","Wisconsin":"55",
     "Wyoming":"56","Puerto Rico":"72","Virgin Islands":"78","All Metropolitan Statistical Areas":"99"
 }
-    
-# Function to scrape job data from city-data.com
-def scrape_city_data(url, fields):
-    response = requests.get(url)
-    if response.status_code != 200:
-        print(f"Failed to retrieve data from {url}: {response.status_code}")
-        return None
 
-    tree = html.fromstring(response.content)
-    
-    data = {}
-    
-    for field_name, field_xpath in fields.items():
-        elements = tree.xpath(field_xpath)
-        if elements:
-            element_text = get_first_num_from_arr(elements[0].split(' '))
-            # Extract the percentage value
-            match = re.search(r'(\d+(\.\d+)?)%', element_text)
-            if match:
-                value = element_text
+# Run metrics: counters and histograms with labels, eg.
+# metrics.increment('http_requests_total', host='data.bls.gov', status=200) or
+# with metrics.timer('stage_seconds', stage='geocode'): ...
+# Exported at the end of a run as JSON or Prometheus text.
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted((label, str(label_value)) for label, label_value in labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted((label, str(label_value)) for label, label_value in labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'count': 0, 'sum': 0.0, 'min': value, 'max': value, 'buckets': [0] * len(HISTOGRAM_BUCKETS)}
+            histogram['count'] += 1
+            histogram['sum'] += value
+            histogram['min'] = min(histogram['min'], value)
+            histogram['max'] = max(histogram['max'], value)
+            histogram['buckets'][bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    # Upper bound of the bucket holding the given quantile
+    @staticmethod
+    def estimate_quantile(histogram, quantile):
+        target = quantile * histogram['count']
+        cumulative = 0
+        for bound, count in zip(HISTOGRAM_BUCKETS, histogram['buckets']):
+            cumulative += count
+            if cumulative >= target:
+                return min(bound, histogram['max'])
+        return histogram['max']
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                'histograms': [
+                    {
+                        'name': name,
+                        'labels': dict(labels),
+                        'count': histogram['count'],
+                        'sum': histogram['sum'],
+                        'min': histogram['min'],
+                        'max': histogram['max'],
+                        'mean': histogram['sum'] / histogram['count'],
+                        'p50': self.estimate_quantile(histogram, 0.5),
+                        'p90': self.estimate_quantile(histogram, 0.9),
+                        'p99': self.estimate_quantile(histogram, 0.99),
+                        'buckets': list(histogram['buckets'])
+                    }
+                    for (name, labels), histogram in sorted(self.histograms.items())
+                ]
+            }
+
+    # Add the metrics exported by another process with to_dict()
+    def merge(self, exported):
+        for counter in exported['counters']:
+            self.increment(counter['name'], counter['value'], **counter['labels'])
+        with self.lock:
+            for exported_histogram in exported['histograms']:
+                key = (exported_histogram['name'], tuple(sorted(exported_histogram['labels'].items())))
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    self.histograms[key] = {name: exported_histogram[name] for name in ('count', 'sum', 'min', 'max')}
+                    self.histograms[key]['buckets'] = list(exported_histogram['buckets'])
+                    continue
+                histogram['count'] += exported_histogram['count']
+                histogram['sum'] += exported_histogram['sum']
+                histogram['min'] = min(histogram['min'], exported_histogram['min'])
+                histogram['max'] = max(histogram['max'], exported_histogram['max'])
+                histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], exported_histogram['buckets'])]
+
+    def to_prometheus(self):
+        def format_labels(labels, extra=()):
+            pairs = [*labels, *extra]
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{label}="{escape_label_value(value)}"' for label, value in pairs) + '}'
+
+        exported = self.to_dict()
+        lines = []
+        for name in sorted({counter['name'] for counter in exported['counters']}):
+            lines.append(f'# TYPE {name} counter')
+            for counter in exported['counters']:
+                if counter['name'] == name:
+                    lines.append(f"{name}{format_labels(counter['labels'].items())} {counter['value']}")
+        for name in sorted({histogram['name'] for histogram in exported['histograms']}):
+            lines.append(f'# TYPE {name} histogram')
+            for histogram in exported['histograms']:
+                if histogram['name'] != name:
+                    continue
+                labels = list(histogram['labels'].items())
+                cumulative = 0
+                for bound, count in zip(HISTOGRAM_BUCKETS, histogram['buckets']):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', le)])} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+    # Write the metrics to a file, as Prometheus text if it ends in .prom and JSON otherwise
+    def save(self, filename):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(filename, 'w') as metrics_file:
+            if filename.endswith('.prom'):
+                metrics_file.write(self.to_prometheus())
             else:
-                # Handle other types of values (e.g., integer values)
+                json.dump(self.to_dict(), metrics_file, indent=4)
+
+metrics = Metrics()
+
+# Log messages go through the 'market_research' logger. Fields passed to log() are kept on the
+# record and written out by the JSON formatter, eg. log(logging.WARNING, "Failed", url=url)
+logger = logging.getLogger('market_research')
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+def log(level, message, **fields):
+    logger.log(level, message, extra={'fields': fields})
+
+def configure_logging(log_format='text', level=logging.INFO):
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonLogFormatter() if log_format == 'json' else logging.Formatter('%(message)s'))
+    logger.handlers[:] = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+# Fetch settings: number of concurrent workers, per-host rate limits (requests per second)
+# and retry policy for rate limiting (429) and server errors (5xx)
+MAX_WORKERS = 8
+HOST_RATE_LIMITS = {
+    'www.city-data.com': 2.0,
+    'data.bls.gov': 1.0,
+    'api.bls.gov': 1.0,
+}
+DEFAULT_RATE_LIMIT = 2.0
+MAX_RETRIES = 5
+RETRY_BACKOFF_FACTOR = 1.0
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+REQUEST_TIMEOUT = 30
+
+# Spaces out requests to a single host so that concurrent workers stay under its rate limit
+class RateLimiter:
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second
+        self.next_request_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_request_time - now
+            self.next_request_time = max(now, self.next_request_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+_session = None
+_rate_limiters = {}
+_fetch_lock = threading.Lock()
+
+# Create a session with keep-alive connection pooling and retry with exponential backoff.
+# Retries honour the Retry-After header sent with 429 responses.
+def create_session(max_workers=MAX_WORKERS):
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util import Retry
+
+    retry = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=RETRY_BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=None,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=len(HOST_RATE_LIMITS) + 1, pool_maxsize=max_workers, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# Change the concurrency and rate limits used by fetch(), eg. configure_fetcher(max_workers=16, rate_limits={'data.bls.gov': 0.5})
+def configure_fetcher(max_workers=None, rate_limits=None):
+    global MAX_WORKERS, _session
+    with _fetch_lock:
+        if max_workers:
+            MAX_WORKERS = max_workers
+        if rate_limits:
+            HOST_RATE_LIMITS.update(rate_limits)
+        _session = None
+        _rate_limiters.clear()
+
+def get_session():
+    global _session
+    with _fetch_lock:
+        if _session is None:
+            _session = create_session(MAX_WORKERS)
+        return _session
+
+def get_rate_limiter(host):
+    with _fetch_lock:
+        if host not in _rate_limiters:
+            _rate_limiters[host] = RateLimiter(HOST_RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT))
+        return _rate_limiters[host]
+
+# Response cache settings: responses are stored gzipped under CACHE_DIR, keyed by a hash of
+# the URL. Entries younger than their host's TTL (seconds) are served without a request, older
+# ones are revalidated with ETag/Last-Modified. With CACHE_ONLY nothing is fetched at all.
+CACHE_ENABLED = True
+CACHE_DIR = '.http_cache'
+CACHE_TTLS = {
+    'www.city-data.com': 30 * 24 * 3600,
+    'data.bls.gov': 24 * 3600,
+}
+DEFAULT_CACHE_TTL = 7 * 24 * 3600
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+CACHE_ONLY = False
+
+_cache_lock = threading.Lock()
+_cache_size = None
+
+# Change the response cache settings, eg. configure_cache(cache_only=True) to run offline
+def configure_cache(enabled=None, cache_dir=None, ttls=None, max_bytes=None, cache_only=None):
+    global CACHE_ENABLED, CACHE_DIR, CACHE_MAX_BYTES, CACHE_ONLY, _cache_size
+    with _cache_lock:
+        if enabled is not None:
+            CACHE_ENABLED = enabled
+        if cache_dir:
+            CACHE_DIR = cache_dir
+        if ttls:
+            CACHE_TTLS.update(ttls)
+        if max_bytes:
+            CACHE_MAX_BYTES = max_bytes
+        if cache_only is not None:
+            CACHE_ONLY = cache_only
+        _cache_size = None
+
+def get_cache_paths(url):
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    directory = os.path.join(CACHE_DIR, key[:2])
+    return os.path.join(directory, f'{key}.json'), os.path.join(directory, f'{key}.gz')
+
+def write_file_atomic(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as temp_file:
+        temp_file.write(content)
+    os.replace(temp_path, path)
+
+# Returns (metadata, body) for a cached URL, or None when it is not cached
+def read_cache_entry(url):
+    meta_path, body_path = get_cache_paths(url)
+    try:
+        with open(meta_path, 'r') as meta_file:
+            meta = json.load(meta_file)
+        with gzip.open(body_path, 'rb') as body_file:
+            content = body_file.read()
+    except (OSError, ValueError, EOFError):
+        return None
+    # Touch the entry so eviction drops the least recently used responses first. Eviction in
+    # another thread may have removed it since it was read, the content is still good to use.
+    try:
+        os.utime(meta_path)
+    except OSError:
+        pass
+    return meta, content
+
+def write_cache_entry(url, meta, content=None):
+    global _cache_size
+    meta_path, body_path = get_cache_paths(url)
+    meta_bytes = json.dumps(meta).encode('utf-8')
+    body_bytes = gzip.compress(content) if content is not None else None
+    with _cache_lock:
+        if body_bytes is not None:
+            write_file_atomic(body_path, body_bytes)
+        write_file_atomic(meta_path, meta_bytes)
+        if _cache_size is not None:
+            _cache_size += len(meta_bytes) + (len(body_bytes) if body_bytes is not None else 0)
+        if _cache_size is None or _cache_size > CACHE_MAX_BYTES:
+            evict_cache()
+
+# Delete least recently used entries until the cache is below 90% of CACHE_MAX_BYTES.
+# Must be called with _cache_lock held.
+def evict_cache():
+    global _cache_size
+    entries = []
+    for directory, _, file_names in os.walk(CACHE_DIR):
+        for file_name in file_names:
+            if file_name.endswith('.json'):
+                meta_path = os.path.join(directory, file_name)
+                body_path = meta_path[:-len('.json')] + '.gz'
                 try:
-                    value = int(element_text)
-                except ValueError:
-                    value = element_text
+                    size = os.path.getsize(meta_path) + os.path.getsize(body_path)
+                    entries.append((os.path.getmtime(meta_path), size, meta_path, body_path))
+                except OSError:
+                    pass
+    _cache_size = sum(entry[1] for entry in entries)
+    if _cache_size <= CACHE_MAX_BYTES:
+        return
+    for _, size, meta_path, body_path in sorted(entries):
+        if _cache_size <= CACHE_MAX_BYTES * 0.9:
+            break
+        for path in (meta_path, body_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        _cache_size -= size
+
+def build_cached_response(url, meta, content):
+    import requests
+
+    response = requests.Response()
+    response.status_code = meta['status_code']
+    response.headers.update(meta['headers'])
+    response.url = url
+    response._content = content
+    response.from_cache = True
+    return response
+
+def build_cache_meta(response, fetched_at):
+    headers = {name: response.headers[name] for name in ('Content-Type', 'ETag', 'Last-Modified') if name in response.headers}
+    return {'url': response.url, 'status_code': response.status_code, 'headers': headers, 'fetched_at': fetched_at}
+
+# Rate limited request through the shared pooled session, recording latency and status per host
+def send_request(method, url, **kwargs):
+    import requests
+
+    host = urlparse(url).netloc
+    get_rate_limiter(host).wait()
+    start = time.perf_counter()
+    try:
+        response = get_session().request(method, url, **kwargs)
+    except requests.RequestException as e:
+        metrics.increment('http_requests_total', host=host, status=type(e).__name__)
+        log(logging.WARNING, f"Request to {url} failed: {e}", event='http_error', method=method, url=url, host=host)
+        raise
+    elapsed = time.perf_counter() - start
+    metrics.observe('http_request_seconds', elapsed, host=host)
+    metrics.increment('http_requests_total', host=host, status=response.status_code)
+    log(logging.DEBUG, f"{method} {url} {response.status_code}", event='http_request', method=method, url=url, host=host,
+        status=response.status_code, seconds=round(elapsed, 4))
+    return response
+
+# Rate limited GET through the shared pooled session and the response cache. Safe to call
+# from worker threads. max_age (seconds) shortens the cache TTL of the host for this call,
+# max_age=0 always revalidates a cached page with the server.
+def fetch(url, max_age=None, **kwargs):
+    kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+    host = urlparse(url).netloc
+    if not CACHE_ENABLED:
+        return send_request('GET', url, **kwargs)
+
+    entry = read_cache_entry(url)
+    now = time.time()
+    if entry:
+        meta, content = entry
+        ttl = CACHE_TTLS.get(host, DEFAULT_CACHE_TTL)
+        if max_age is not None:
+            ttl = min(ttl, max_age)
+        if CACHE_ONLY or now - meta['fetched_at'] < ttl:
+            metrics.increment('http_cache_total', host=host, result='hit')
+            return build_cached_response(url, meta, content)
+    elif CACHE_ONLY:
+        import requests
+
+        metrics.increment('http_cache_total', host=host, result='offline_miss')
+        response = requests.Response()
+        response.status_code = 504
+        response.url = url
+        response._content = b''
+        return response
+
+    # Revalidate stale entries with a conditional request
+    headers = dict(kwargs.pop('headers', None) or {})
+    if entry:
+        if 'ETag' in meta['headers']:
+            headers['If-None-Match'] = meta['headers']['ETag']
+        if 'Last-Modified' in meta['headers']:
+            headers['If-Modified-Since'] = meta['headers']['Last-Modified']
+
+    response = send_request('GET', url, headers=headers, **kwargs)
+    if response.status_code == 304 and entry:
+        metrics.increment('http_cache_total', host=host, result='revalidated')
+        meta['fetched_at'] = now
+        write_cache_entry(url, meta)
+        return build_cached_response(url, meta, content)
+    metrics.increment('http_cache_total', host=host, result='miss')
+    if response.status_code == 200:
+        write_cache_entry(url, build_cache_meta(response, now), response.content)
+    return response
+
+# Value types for city fields:
+#   count: first number as an int, eg. "123,456 (100% urban)" -> 123456
+#   currency: dollar amount as an int (float if it has cents), eg. "$65,432" -> 65432
+#   percent: number before the % sign as a float in percent units, eg. "+25.3%" -> 25.3
+#   number: first number as a float, eg. "245.3" -> 245.3
+#   text: the text with whitespace collapsed
+#   auto: the previous untyped conversion, used for fields without a declared type
+NUMBER_PATTERN = re.compile(r'[-+]?\d[\d,]*(?:\.\d+)?')
+PERCENT_PATTERN = re.compile(r'([-+]?\d[\d,]*(?:\.\d+)?)\s*%')
+
+def parse_number(text):
+    match = NUMBER_PATTERN.search(text)
+    return float(match.group().replace(',', '')) if match else None
+
+def to_count(text):
+    value = parse_number(text)
+    return int(value) if value is not None else None
+
+def to_currency(text):
+    value = parse_number(text)
+    return int(value) if value is not None and value.is_integer() else value
+
+def to_percent(text):
+    match = PERCENT_PATTERN.search(text)
+    return float(match.group(1).replace(',', '')) if match else parse_number(text)
+
+def to_text(text):
+    return ' '.join(text.split()) or None
+
+def to_auto(text):
+    element_text = get_first_num_from_arr(text.split(' '))
+    if element_text is None or re.search(r'(\d+(\.\d+)?)%', element_text):
+        return element_text
+    try:
+        return int(element_text)
+    except ValueError:
+        return element_text
+
+value_converters = {
+    'count': to_count,
+    'currency': to_currency,
+    'percent': to_percent,
+    'number': parse_number,
+    'text': to_text,
+    'auto': to_auto,
+}
+
+SECTION_ID_PATTERN = re.compile(r'@id="([^"]+)"')
+
+# Extracts city fields from a city page. The XPaths are compiled once and every value is
+# converted to its declared type in the same pass. Compiled XPaths and parsers are not
+# shared between threads, use get_city_page_extractor() to get one for the current thread.
+class CityPageExtractor:
+    def __init__(self, fields, field_types=None):
+        field_types = field_types or {}
+        self.fields = [
+            (field_name, etree.XPath(field_xpath), value_converters[field_types.get(field_name, 'auto')])
+            for field_name, field_xpath in fields.items()
+        ]
+        self.field_section_ids = {field_name: SECTION_ID_PATTERN.findall(field_xpath) for field_name, field_xpath in fields.items()}
+        self.section_ids = sorted({section_id for section_ids in self.field_section_ids.values() for section_id in section_ids})
+        self.parser = html.HTMLParser(remove_comments=True, remove_pis=True, no_network=True)
+
+    # Cut the page at the first <section> that starts after the last section the fields read
+    # from, so the rest of the page (schools, neighborhoods, forum posts...) is never parsed
+    def get_relevant_content(self, content):
+        last_section = max((content.find(f'id="{section_id}"'.encode()) for section_id in self.section_ids), default=-1)
+        if last_section < 0:
+            return content
+        end = content.find(b'<section', last_section)
+        return content[:end] if end > 0 else content
+
+    # Returns (data, missing field names) for the raw page content
+    def extract(self, content):
+        with metrics.timer('city_page_extract_seconds'):
+            relevant_content = self.get_relevant_content(content)
+            data, missing = self.extract_tree(html.fromstring(relevant_content, parser=self.parser))
+            if len(relevant_content) < len(content) and self.needs_full_parse(missing, content, relevant_content):
+                # Pages laid out differently than expected are parsed in full
+                metrics.increment('city_page_full_parses_total')
+                data, missing = self.extract_tree(html.fromstring(content, parser=self.parser))
+        for field_name in data:
+            metrics.increment('xpath_lookups_total', field=field_name)
+        for field_name in missing:
+            metrics.increment('xpath_misses_total', field=field_name)
+        return data, missing
+
+    # The cut keeps every section id it finds, so a missing field whose section is in the cut
+    # content, or nowhere in the page (eg. small cities without a crime table), is genuinely
+    # missing. Only a field without a section id, or whose section id was not found in the cut
+    # but does appear further down (eg. written as id='...'), may be in the rest of the page.
+    def needs_full_parse(self, missing, content, relevant_content):
+        return any(
+            not self.field_section_ids[field_name]
+            or any(f'id="{section_id}"'.encode() not in relevant_content and content.find(section_id.encode(), len(relevant_content)) >= 0
+                   for section_id in self.field_section_ids[field_name])
+            for field_name in missing
+        )
+
+    def extract_tree(self, tree):
+        data = {}
+        missing = []
+        for field_name, field_xpath, convert in self.fields:
+            elements = field_xpath(tree)
+            value = None
+            if elements:
+                element = elements[0]
+                value = convert(element if isinstance(element, str) else element.text_content())
+            if value is None:
+                missing.append(field_name)
             data[field_name] = value
-        else:
-            print(f"Failed to find the text '{field_name}' in {url}.")
-            data[field_name] = None
+        return data, missing
+
+_extractors = threading.local()
+
+def get_city_page_extractor(fields, field_types=None):
+    key = (tuple(fields.items()), tuple(sorted((field_types or {}).items())))
+    extractors = getattr(_extractors, 'extractors', None)
+    if extractors is None:
+        extractors = _extractors.extractors = {}
+    if key not in extractors:
+        extractors[key] = CityPageExtractor(fields, field_types)
+    return extractors[key]
+
+# Function to scrape job data from city-data.com
+def scrape_city_data(url, fields, field_types=None, max_age=None):
+    response = fetch(url, max_age=max_age)
+    if response.status_code != 200:
+        log(logging.WARNING, f"Failed to retrieve data from {url}: {response.status_code}", event='fetch_failed', url=url, status=response.status_code)
+        return None
+
+    data, missing = get_city_page_extractor(fields, field_types).extract(response.content)
+    for field_name in missing:
+        log(logging.WARNING, f"Failed to find the text '{field_name}' in {url}.", event='xpath_miss', url=url, field=field_name)
 
     return data
 
@@ -99,37 +646,179 @@ def clean_int(number_string):
 
 # Function to scrape job data from the BLS website
 def scrape_bls_data(url):
-    response = requests.get(url)
+    response = fetch(url)
     if response.status_code != 200:
-        print(f"Failed to retrieve data from {url}: {response.status_code}")
+        log(logging.WARNING, f"Failed to retrieve data from {url}: {response.status_code}", event='fetch_failed', url=url, status=response.status_code)
         return None
 
     tree = html.fromstring(response.content)
-    
-    # Extract the data for the most recent month and the same month in the previous year
-    values = tree.xpath('//*[@id="table0"]/tbody/tr/td[1]/text()')
 
+    # One row per year and one column per month, the header names the month of each column.
+    # Months not published yet are empty, other columns (eg. Annual) are skipped.
+    headers = [cell.text_content().strip() for cell in tree.xpath('//*[@id="table0"]/thead/tr/th')]
+    months = {column: MONTH_ABBREVIATIONS.index(header) + 1 for column, header in enumerate(headers) if header in MONTH_ABBREVIATIONS}
+    values = {}
+    for row in tree.xpath('//*[@id="table0"]/tbody/tr'):
+        cells = row.xpath('th|td')
+        year = parse_number(cells[0].text_content()) if cells else None
+        if year is None:
+            continue
+        for column, cell in enumerate(cells):
+            # Values may carry a footnote, eg. "1,354.1(P)" for preliminary estimates
+            value = parse_number(cell.text_content()) if column in months else None
+            if value is not None:
+                values[(int(year), months[column])] = value
+
+    job_data = get_job_data(values)
+    if not job_data:
+        log(logging.WARNING, f"Failed to extract job data from {url}", event='bls_page_miss', url=url)
+    return job_data
+
+# BLS timeseries JSON API: https://www.bls.gov/developers/api_signature_v2.htm
+# Without a registration key the API accepts 25 series per request, with one it accepts 50.
+# Point BLS_API_URL at a local server to run without BLS.
+BLS_TIMESERIES_URL = 'https://data.bls.gov/timeseries/'
+BLS_API_URL = os.environ.get('BLS_API_URL', 'https://api.bls.gov/publicAPI/v2/timeseries/data/')
+BLS_API_KEY = os.environ.get('BLS_API_KEY', '')
+BLS_API_BATCH_SIZE = 50 if BLS_API_KEY else 25
+
+# Function to construct the BLS series ID from series components: https://www.bls.gov/help/hlpforma.htm#SM
+def construct_bls_series_id(state, area_code):
+    return f"SMU{state_code_map[state]}{area_code}0000000001"
+
+# Function to construct the BLS URL from series components
+def construct_bls_url(state, area_code):
+    series_id = construct_bls_series_id(state, area_code)
+    bls_url = f"{BLS_TIMESERIES_URL}{series_id}"
+    return bls_url
+
+# Job data already retrieved in this run, keyed by series ID
+bls_series_data = {}
+bls_series_lock = threading.Lock()
+
+MONTH_ABBREVIATIONS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+# Job data from {(year, month): value}: the latest month and the same month a year earlier,
+# or None when that month has no value a year earlier. Both BLS sources return this shape.
+def get_job_data(values):
     if not values:
-        print(f"Failed to extract job data from {url}")
         return None
 
-    try:
-        most_recent_value = float(values[-1].replace(',', ''))
-        previous_year_value = float(values[-2].replace(',', ''))
+    year, month = max(values)
+    if (year - 1, month) not in values:
+        return None
 
-        return {
-            'most_recent_value': most_recent_value,
-            'previous_year_value': previous_year_value
+    return {
+        'reference_month': f"{year}-{month:02d}",
+        'most_recent_value': values[(year, month)],
+        'previous_year_value': values[(year - 1, month)]
+    }
+
+# Parse one series of a BLS API response into the latest month and the same month a year earlier
+def parse_bls_series(series):
+    values = {}
+    for item in series.get('data', []):
+        if item['period'].startswith('M') and item['period'] != 'M13':
+            try:
+                values[(int(item['year']), int(item['period'][1:]))] = float(item['value'].replace(',', ''))
+            except ValueError:
+                pass
+    return get_job_data(values)
+
+# Rate limited JSON POST through the shared pooled session, responses are not cached
+def post_json(url, payload):
+    return send_request('POST', url, json=payload, timeout=REQUEST_TIMEOUT)
+
+# Fetch job data for many series IDs through the BLS API, a batch of series per request.
+# Returns {series ID: job data} and memoizes results for the rest of the run. Series missing
+# from the API response fall back to scraping their timeseries page.
+def fetch_bls_series(series_ids):
+    import requests
+
+    with bls_series_lock:
+        missing = sorted(set(series_ids) - set(bls_series_data))
+    metrics.increment('bls_series_total', len(set(series_ids)) - len(missing), source='memo')
+
+    end_year = datetime.now().year
+    for start in range(0, len(missing), BLS_API_BATCH_SIZE):
+        batch = missing[start:start + BLS_API_BATCH_SIZE]
+        payload = {
+            'seriesid': batch,
+            'startyear': str(end_year - 2),
+            'endyear': str(end_year)
         }
-    except Exception as e:
-        print(f"Error parsing job data: {e}")
-        return None
+        if BLS_API_KEY:
+            payload['registrationkey'] = BLS_API_KEY
 
-# Function to construct the BLS URL from series components: https://www.bls.gov/help/hlpforma.htm#SM
-def construct_bls_url(state, area_code):
-    series_id = f"SMU{state_code_map[state]}{area_code}0000000001"
-    bls_url = f"https://data.bls.gov/timeseries/{series_id}"
-    return bls_url
+        results = {}
+        try:
+            response = post_json(BLS_API_URL, payload)
+            body = response.json() if response.status_code == 200 else {}
+            if body.get('status') == 'REQUEST_SUCCEEDED':
+                for series in body['Results']['series']:
+                    results[series['seriesID']] = parse_bls_series(series)
+            else:
+                log(logging.WARNING, f"Failed to retrieve data from {BLS_API_URL}: {response.status_code} {body.get('message', '')}",
+                    event='bls_api_failed', url=BLS_API_URL, status=response.status_code)
+        except (requests.RequestException, ValueError) as e:
+            log(logging.WARNING, f"Error requesting BLS series: {e}", event='bls_api_error', url=BLS_API_URL)
+
+        for series_id in batch:
+            job_data = results.get(series_id)
+            source = 'api'
+            if not job_data:
+                url = f"{BLS_TIMESERIES_URL}{series_id}"
+                source = 'page'
+                # One unreachable page only loses its own series
+                try:
+                    job_data = scrape_bls_data(url)
+                except requests.RequestException as e:
+                    log(logging.WARNING, f"Error requesting {url}: {e}", event='bls_page_error', url=url)
+                    job_data = None
+            metrics.increment('bls_series_total', source=source if job_data else 'missing')
+            with bls_series_lock:
+                bls_series_data[series_id] = job_data
+
+    with bls_series_lock:
+        return {series_id: bls_series_data[series_id] for series_id in series_ids}
+
+# Job data of earlier runs is kept in <output dir>/bls_series.json, {series ID: job data}, so a
+# refresh only asks BLS again for series that should have a newer month by now. State and
+# metro area estimates of a month are published around seven weeks after it starts.
+BLS_SERIES_FILE = 'bls_series.json'
+BLS_RELEASE_LAG_DAYS = 50
+
+# The latest reference month ('YYYY-MM') BLS is expected to have published at now
+def get_expected_reference_month(now=None):
+    return ((now or datetime.now()) - timedelta(days=BLS_RELEASE_LAG_DAYS)).strftime('%Y-%m')
+
+def load_bls_series(path):
+    try:
+        with open(path, 'r') as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return {}
+
+def save_bls_series(path, series):
+    write_file_atomic(os.path.abspath(path), json.dumps(series, indent=4, sort_keys=True).encode())
+
+# Merge {series ID: job data} into the stored job data, series without job data are left out
+def update_bls_series(path, series):
+    stored_series = load_bls_series(path)
+    stored_series.update((series_id, job_data) for series_id, job_data in series.items() if job_data)
+    save_bls_series(path, stored_series)
+
+# Add the stored job data that is still current to the memo of this run, so fetch_bls_series()
+# only requests the series without a stored value or with an older reference month than
+# expected. Series scraped from timeseries pages have no reference month and are refetched.
+def reuse_bls_series(stored_series, expected_reference_month=None):
+    expected_reference_month = expected_reference_month or get_expected_reference_month()
+    current = {series_id: job_data for series_id, job_data in stored_series.items()
+               if job_data and (job_data.get('reference_month') or '') >= expected_reference_month}
+    with bls_series_lock:
+        for series_id, job_data in current.items():
+            bls_series_data.setdefault(series_id, job_data)
+    return current
 
 """
 UNCOMMENT IF WE NEED TO RE-GENERATE area_data.json
@@ -159,37 +848,212 @@ UNCOMMENT IF WE NEED TO RE-GENERATE area_data.json
 # with open("area_data.json", "w") as json_file:
 #     json.dump(area_data, json_file, indent=4)
 
-# Create a dictionary to cache city coordinates
-# ADD YOUR OWN API KEY HERE
-geolocator = GoogleV3(api_key='')
+# The geocoder is only created when a city is missing from the geocode store, so runs that
+# only use stored coordinates (or a local stand-in server) don't need an API key
+def create_geolocator():
+    from geopy.geocoders import GoogleV3
 
-with open("area_data.json", "r") as json_file:
-    area_data = json.load(json_file)
+    # ADD YOUR OWN API KEY HERE
+    return GoogleV3(api_key='')
 
-with open("city_data.json", "r") as json_file:
-    city_data = json.load(json_file)
+geolocator = None
 
-def get_city_coordinates(city_name):
-    if city_name in city_data:
-        return city_data[city_name]['coordinates']
-    else:
-        location = geolocator.geocode(city_name)
-        if location:
-            coordinates = (location.latitude, location.longitude)
-            city_data[city_name] = {
-                "coordinates": coordinates
-            }
-            with open("city_data.json", "w") as json_file:
-                json.dump(city_data, json_file, indent=4)
-            return coordinates
-        else:
+def get_geolocator():
+    global geolocator
+    if geolocator is None:
+        geolocator = create_geolocator()
+    return geolocator
+
+# Geocoded coordinates are kept in a SQLite database (WAL mode), so worker threads and
+# processes can read and add coordinates without rewriting a whole JSON file per city.
+# city_data.json and area_data.json are imported into it the first time it is created.
+GEOCODE_DB = 'geocode.sqlite3'
+GEOCODE_WORKERS = 4
+SQLITE_MAX_VARIABLES = 500
+
+class GeocodeStore:
+    def __init__(self, path=GEOCODE_DB):
+        self.path = path
+        self.area_table_path = f"{os.path.splitext(path)[0]}_areas.npy"
+        self.local = threading.local()
+        connection = self.connect()
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS cities (name TEXT PRIMARY KEY, latitude REAL, longitude REAL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS areas (name TEXT PRIMARY KEY, area_code TEXT, latitude REAL, longitude REAL)')
+
+    # One connection per thread, sqlite3 connections can't be shared between threads
+    def connect(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def is_empty(self, table):
+        return self.connect().execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone() is None
+
+    def get_city(self, city_name):
+        row = self.connect().execute('SELECT latitude, longitude FROM cities WHERE name = ?', (city_name,)).fetchone()
+        return row
+
+    # Returns {city name: (latitude, longitude)} for the cities that are stored
+    def get_cities(self, city_names):
+        city_names = list(city_names)
+        cities = {}
+        for start in range(0, len(city_names), SQLITE_MAX_VARIABLES):
+            batch = city_names[start:start + SQLITE_MAX_VARIABLES]
+            placeholders = ','.join('?' * len(batch))
+            for name, latitude, longitude in self.connect().execute(
+                    f'SELECT name, latitude, longitude FROM cities WHERE name IN ({placeholders})', batch):
+                cities[name] = (latitude, longitude)
+        return cities
+
+    def load_cities(self):
+        return {name: (latitude, longitude) for name, latitude, longitude in self.connect().execute('SELECT name, latitude, longitude FROM cities')}
+
+    # Add or replace many cities in one transaction, cities is {city name: (latitude, longitude)}
+    def put_cities(self, cities):
+        connection = self.connect()
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO cities (name, latitude, longitude) VALUES (?, ?, ?)',
+                [(name, coordinates[0], coordinates[1]) for name, coordinates in cities.items()]
+            )
+
+    # Returns the metro areas in the same shape as area_data.json
+    def load_areas(self):
+        return {
+            name: {'area_code': area_code, 'coordinates': [latitude, longitude] if latitude is not None else None}
+            for name, area_code, latitude, longitude in self.connect().execute('SELECT name, area_code, latitude, longitude FROM areas ORDER BY rowid')
+        }
+
+    def put_areas(self, areas):
+        connection = self.connect()
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO areas (name, area_code, latitude, longitude) VALUES (?, ?, ?, ?)',
+                [(name, area['area_code'], *(area.get('coordinates') or (None, None))) for name, area in areas.items()]
+            )
+        try:
+            os.remove(self.area_table_path)
+        except OSError:
+            pass
+
+    # The metro areas with coordinates as a NumPy structured array (name, area_code, latitude,
+    # longitude), memory-mapped from a .npy file next to the database. The file is built from
+    # the areas table the first time and rebuilt after put_areas().
+    def load_area_table(self):
+        import numpy as np
+
+        try:
+            return np.load(self.area_table_path, mmap_mode='r')
+        except (OSError, ValueError):
+            pass
+        table = build_area_table(self.load_areas())
+        temp_path = f'{self.area_table_path[:-len(".npy")]}.{os.getpid()}.{threading.get_ident()}.tmp.npy'
+        np.save(temp_path, table)
+        os.replace(temp_path, self.area_table_path)
+        return table
+
+    # Bulk import city_data.json / area_data.json style files
+    def import_json(self, city_json_path=None, area_json_path=None):
+        if city_json_path and os.path.exists(city_json_path):
+            with open(city_json_path, "r") as json_file:
+                self.put_cities({name: city['coordinates'] for name, city in json.load(json_file).items() if city.get('coordinates')})
+        if area_json_path and os.path.exists(area_json_path):
+            with open(area_json_path, "r") as json_file:
+                self.put_areas(json.load(json_file))
+
+def open_geocode_store(path=GEOCODE_DB):
+    store = GeocodeStore(path)
+    # Each table is imported on its own, so a table left empty by an interrupted import is
+    # filled on the next run
+    store.import_json("city_data.json" if store.is_empty('cities') else None,
+                      "area_data.json" if store.is_empty('areas') else None)
+    return store
+
+# The store and the metro areas are opened on first use rather than at import
+geocode_store = None
+area_data = None
+geocode_store_lock = threading.Lock()
+
+def get_geocode_store():
+    global geocode_store
+    with geocode_store_lock:
+        if geocode_store is None:
+            geocode_store = open_geocode_store()
+        return geocode_store
+
+# Returns the metro areas in the same shape as area_data.json
+def get_area_data():
+    global area_data
+    if area_data is None:
+        area_data = get_geocode_store().load_areas()
+    return area_data
+
+# Convert metro areas in the shape of area_data.json to the structured array that
+# MetroAreaIndex and GeocodeStore.load_area_table() use, areas without coordinates are left out
+def build_area_table(area_data):
+    import numpy as np
+
+    areas = [(area_name, area['area_code'], *area['coordinates']) for area_name, area in area_data.items() if area.get('coordinates')]
+    name_length = max([len(area[0]) for area in areas], default=1)
+    code_length = max([len(area[1]) for area in areas], default=1)
+    dtype = [('name', f'U{name_length}'), ('area_code', f'U{code_length}'), ('latitude', 'f8'), ('longitude', 'f8')]
+    return np.array(areas, dtype=dtype)
+
+# A geocoder error (timeout, quota, bad key...) only loses the coordinates of this city
+def geocode_city(city_name):
+    from geopy.exc import GeopyError
+
+    with metrics.timer('geocode_request_seconds'):
+        try:
+            location = get_geolocator().geocode(city_name)
+        except GeopyError as e:
+            metrics.increment('geocode_requests_total', result='error')
+            log(logging.WARNING, f"Failed to geocode {city_name}: {e}", event='geocode_failed', city=city_name)
             return None
+    metrics.increment('geocode_requests_total', result='found' if location else 'not_found')
+    if location:
+        return (location.latitude, location.longitude)
+    log(logging.WARNING, f"Failed to geocode {city_name}", event='geocode_failed', city=city_name)
+    return None
+
+def get_city_coordinates(city_name):
+    coordinates = get_geocode_store().get_city(city_name)
+    metrics.increment('geocode_cache_total', result='hit' if coordinates else 'miss')
+    if coordinates:
+        return coordinates
+    coordinates = geocode_city(city_name)
+    if coordinates:
+        get_geocode_store().put_cities({city_name: coordinates})
+    return coordinates
+
+# Resolve the coordinates of many cities at once: stored cities come from one query, the rest
+# are geocoded concurrently and written back in a single transaction.
+# Returns {city name: (latitude, longitude)} for every city that could be resolved.
+def geocode_cities(city_names, max_workers=GEOCODE_WORKERS):
+    city_names = list(dict.fromkeys(city_names))
+    coordinates = get_geocode_store().get_cities(city_names)
+    missing = [city_name for city_name in city_names if city_name not in coordinates]
+    metrics.increment('geocode_cache_total', len(coordinates), result='hit')
+    metrics.increment('geocode_cache_total', len(missing), result='miss')
+    if missing:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            geocoded = {city_name: location for city_name, location in zip(missing, executor.map(geocode_city, missing)) if location}
+        get_geocode_store().put_cities(geocoded)
+        coordinates.update(geocoded)
+    return coordinates
 
 def get_area_coordinates(area_name):
+    area_data = get_area_data()
     if area_name in area_data:
         return area_data[area_name]['coordinates']
     else:
-        print ("Missing area name, uncomment the code below to generate coordinates for: " + area_name)
+        log(logging.WARNING, f"Missing area name, uncomment the code below to generate coordinates for: {area_name}",
+            event='area_missing', area=area_name)
         # area codes should have all been pre-generated, but uncomment below if needed
         # location = geolocator.geocode(area_name) 
         # if location:
@@ -198,39 +1062,147 @@ def get_area_coordinates(area_name):
         # else:
         #     return None
 
-def find_closest_metro_area(target_city_name):
+EARTH_RADIUS_KM = 6371.0088
+# Nearest haversine candidates that are re-ranked with geopy's geodesic distance, so the
+# index picks the same metro area as a full geodesic scan
+GEODESIC_CANDIDATES = 5
+QUERY_CHUNK_SIZE = 1024
+
+# Get the state initials from a metro area name, eg. "Charlotte-Concord-Gastonia, NC-SC" -> ['NC', 'SC']
+def get_area_states(area_name):
+    suffix = area_name.rsplit(', ', 1)[-1]
+    return suffix.split(' ')[0].split('-')
+
+# Nearest metro area lookup over an area table (see build_area_table()), built once and
+# queried with vectorized haversine distances
+class MetroAreaIndex:
+    def __init__(self, table):
+        import numpy as np
+
+        self.area_names = table['name'].tolist()
+        self.area_codes = table['area_code'].tolist()
+        self.area_positions = {area_name: position for position, area_name in enumerate(self.area_names)}
+        self.latitudes_deg = np.asarray(table['latitude'])
+        self.longitudes_deg = np.asarray(table['longitude'])
+        self.latitudes = np.radians(self.latitudes_deg)
+        self.longitudes = np.radians(self.longitudes_deg)
+        self.cos_latitudes = np.cos(self.latitudes)
+        self.area_states = [set(get_area_states(area_name)) for area_name in self.area_names]
+        self.state_masks = {}
+
+    # Returns None for a name that is not in the index
+    def get_area_code(self, area_name):
+        position = self.area_positions.get(area_name)
+        return None if position is None else self.area_codes[position]
+
+    def get_state_mask(self, state):
+        import numpy as np
+
+        if state not in self.state_masks:
+            self.state_masks[state] = np.array([state in area_states for area_states in self.area_states])
+        return self.state_masks[state]
+
+    # Haversine distances in km, one row per query coordinate and one column per metro area
+    def haversine_distances(self, coords):
+        import numpy as np
+
+        coords = np.radians(np.asarray(coords, dtype=float).reshape(-1, 2))
+        latitudes = coords[:, 0:1]
+        longitudes = coords[:, 1:2]
+        a = (np.sin((latitudes - self.latitudes) / 2) ** 2
+             + np.cos(latitudes) * self.cos_latitudes * np.sin((longitudes - self.longitudes) / 2) ** 2)
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+    # Returns the k nearest metro areas to coords as a list of (area_name, distance_km).
+    # When state is given (eg. 'TX') only metro areas in that state are considered.
+    def query(self, coords, k=1, state=None):
+        return self.query_batch([coords], k=k, state=state)[0]
+
+    # Same as query() for many coordinates at once, a None coordinate gives an empty list
+    def query_batch(self, coords_list, k=1, state=None):
+        import numpy as np
+        from geopy.distance import geodesic
+
+        results = [[] for _ in coords_list]
+        valid = [i for i, coords in enumerate(coords_list) if coords]
+        mask = self.get_state_mask(state) if state else None
+        candidate_indices = np.arange(len(self.area_names)) if mask is None else np.flatnonzero(mask)
+        if not valid or not len(candidate_indices):
+            return results
+
+        num_candidates = min(k + GEODESIC_CANDIDATES, len(candidate_indices))
+        for start in range(0, len(valid), QUERY_CHUNK_SIZE):
+            chunk = valid[start:start + QUERY_CHUNK_SIZE]
+            distances = self.haversine_distances([coords_list[i] for i in chunk])[:, candidate_indices]
+            nearest = np.argpartition(distances, num_candidates - 1, axis=1)[:, :num_candidates]
+            for row, i in enumerate(chunk):
+                # Keep area_data order for ties, like the original geodesic loop did
+                indices = np.sort(candidate_indices[nearest[row]])
+                ranked = sorted(
+                    ((self.area_names[index], geodesic(coords_list[i], (self.latitudes_deg[index], self.longitudes_deg[index])).kilometers)
+                     for index in indices),
+                    key=lambda item: item[1]
+                )
+                results[i] = ranked[:k]
+        return results
+
+metro_index = None
+metro_index_lock = threading.Lock()
+
+def get_metro_index():
+    global metro_index
+    with metro_index_lock:
+        if metro_index is None:
+            metro_index = MetroAreaIndex(get_geocode_store().load_area_table())
+        return metro_index
+
+# Find the nearest metro area to a city, eg. find_closest_metro_area("Plano, TX").
+# With same_state=True only metro areas of the city's own state are considered.
+def find_closest_metro_area(target_city_name, same_state=False):
     target_coords = get_city_coordinates(target_city_name)
     if not target_coords:
         return None
 
-    closest_metro_area = None
-    min_distance = float('inf')
-
-    for area_name in area_data:
-        metro_area_coords = get_area_coordinates(area_name)
-        if metro_area_coords:
-            distance = geodesic(target_coords, metro_area_coords).kilometers
-            if distance < min_distance:
-                min_distance = distance
-                closest_metro_area = area_name
-
-    return closest_metro_area
+    state = target_city_name.rsplit(', ', 1)[-1] if same_state else None
+    with metrics.timer('metro_lookup_seconds'):
+        nearest = get_metro_index().query(target_coords, state=state)
+    if not nearest:
+        return None
+    return nearest[0][0]
 
-# Function to save data to a spreadsheet
-def save_to_spreadsheet(data, filename):
-    df = pd.DataFrame(data)
-    df.to_excel(filename, index=False)
-    print(f"Data saved to {filename}")
+# Batch version of find_closest_metro_area, returns {city name: closest metro area or None}.
+# Coordinates already resolved with geocode_cities() can be passed in.
+def find_closest_metro_areas(target_city_names, same_state=False, coordinates=None):
+    index = get_metro_index()
+    city_names = list(target_city_names)
+    if coordinates is None:
+        coordinates = geocode_cities(city_names)
+    coords_list = [coordinates.get(city_name) for city_name in city_names]
+    with metrics.timer('metro_lookup_batch_seconds'):
+        if same_state:
+            nearest_list = [index.query(coords, state=city_name.rsplit(', ', 1)[-1]) if coords else []
+                            for city_name, coords in zip(city_names, coords_list)]
+        else:
+            nearest_list = index.query_batch(coords_list)
+    return {city_name: nearest[0][0] if nearest else None for city_name, nearest in zip(city_names, nearest_list)}
 
 def calculate_job_growth(most_recent_value, previous_year_value):
     if previous_year_value == 0:
         return None
     return ((most_recent_value - previous_year_value) / previous_year_value)
 
-def scrape_cities(url, state, min_population):
-    response = requests.get(url)
+# Returns {city: population} for the cities above min_population, or None when the state index
+# can't be fetched
+def scrape_cities(url, state, min_population, max_age=None):
+    import requests
+
+    try:
+        response = fetch(url, max_age=max_age)
+    except requests.RequestException as e:
+        log(logging.WARNING, f"Error requesting {url}: {e}", event='fetch_failed', url=url)
+        return None
     if response.status_code != 200:
-        print(f"Failed to retrieve data from {url}: {response.status_code}")
+        log(logging.WARNING, f"Failed to retrieve data from {url}: {response.status_code}", event='fetch_failed', url=url, status=response.status_code)
         return None
 
     tree = html.fromstring(response.content)
@@ -252,85 +1224,565 @@ def scrape_cities(url, state, min_population):
 
     return cities
 
-# Main function
-def main():
-    base_url_city = 'https://www.city-data.com/city/'
-
-    city_fields = {
-        'Population in 2022': '//*[@id="city-population"]/b[1]/following-sibling::text()[1]',
-        'Population change since 2000 (%)': '//*[@id="city-population"]/b[2]/following-sibling::text()[1]',
-        'Median household income in 2022': '//*[@id="median-income"]/b[1]/following-sibling::text()[1]',
-        'Median household income in 2000': '//*[@id="median-income"]/b[2]/following-sibling::text()[1]',
-        'Median condo value in 2022': '//*[@id="median-income"]/b[7]/following-sibling::text()[1]',
-        'Median condo value in 2000': '//*[@id="median-income"]/b[8]/following-sibling::text()[1]',
-        'Median contract rent': '//*[@id="median-rent"]/p/text()',
-        'Poverty percentage': '//*[@id="poverty-level"]/b[1]/following-sibling::text()[1]',
-        'Largest ethnicity percentage': '//*[@id="races-graph"]/div/ul/li[2]/ul/li[1]/span[2]/text()',
-        'Largest ethnicity slice': '//*[@id="races-graph"]/div/ul/li[2]/ul/li[1]/b/text()',
-        'Most recent crime index': '//*[@id="crimeTab"]/tfoot/tr/td[last()]//text()',
-        'Unemployment rate': '//*[@id="unemployment"]/div[1]/table/tr[1]/td[2]/text()'
-    }
+# Scrape a single city page and add its job growth, returns one spreadsheet row or None
+def scrape_city(city, state, city_fields, closest_metro_area=None, job_data=None, max_age=None):
+    log(logging.INFO, f"Scraping {city}, {state}", event='scrape_city', city=city, state=state)
+    city_slug = city.replace(' ', '-').replace("'", '')
+    state_slug = state.replace(' ', '-')
+    url_city = f'{CITY_DATA_URL}{city_slug}-{state_slug}.html'
+    city_data = scrape_city_data(url_city, city_fields, city_field_types, max_age)
+    if not city_data:
+        return None
 
-    STATES_TO_ANALYZE = {
-        'North Carolina', 'Alabama', 'Georgia'
+    row = {
+        'City': city.replace('-', ', '),
+        'Closest Metro Area': None
     }
+    row.update(city_data)
+    row['Job Growth (%)'] = None
 
-    # Specify the minimum population for inclusion
-    MIN_POPULATION = 50000
-    for state in STATES_TO_ANALYZE:            
-        url = f'https://www.city-data.com/city/{state.replace(' ', '-')}.html'
-        cities_data = scrape_cities(url, state, MIN_POPULATION)
+    if closest_metro_area and job_data:
+        row['Job Growth (%)'] = calculate_job_growth(job_data['most_recent_value'], job_data['previous_year_value'])
+        row['Closest Metro Area'] = closest_metro_area
 
-        # Setup headers
-        data = {
-            'City': [],
-            'Closest Metro Area': []
-        }
+    return row
 
-        for field in city_fields.keys():
-            data[field] = []
-
-        data['Job Growth (%)'] = []
-
-        # Save the data to a JSON file
-        with open(f"{state.replace(' ', '').lower()}_cities_population.json", "w") as outfile:
-            json.dump(cities_data, outfile, indent=4)
-        
-        with open(f"{state.replace(' ', '').lower()}_cities_population.json", "r") as json_file:
-            cities_to_analyze = json.load(json_file)
-        
-        for city in cities_to_analyze:
-            print(f"Scraping {city}, {state}")
-            url_city = f'{base_url_city}{city.replace(' ', '-').replace('\'', '')}-{state.replace(' ', '-')}.html'
-            city_data = scrape_city_data(url_city, city_fields)
-            if city_data:
-                data['City'].append(city.replace('-', ', '))
-                for field, value in city_data.items():
-                    data[field].append(value)
-            
-                # Scrape job data and calculate job growth for each city
-                closest_metro_area = find_closest_metro_area(f"{city}, {state_initials[state]}")
-                if closest_metro_area:
-                    bls_url = construct_bls_url(state, area_data[closest_metro_area]['area_code'])
-                    job_data = scrape_bls_data(bls_url)
-                    if job_data:
-                        job_growth = calculate_job_growth(job_data['most_recent_value'], job_data['previous_year_value'])
-                        data['Job Growth (%)'].append(job_growth)
-                        data['Closest Metro Area'].append(closest_metro_area)
+CITY_DATA_URL = 'https://www.city-data.com/city/'
+
+city_fields = {
+    'Population in 2022': '//*[@id="city-population"]/b[1]/following-sibling::text()[1]',
+    'Population change since 2000 (%)': '//*[@id="city-population"]/b[2]/following-sibling::text()[1]',
+    'Median household income in 2022': '//*[@id="median-income"]/b[1]/following-sibling::text()[1]',
+    'Median household income in 2000': '//*[@id="median-income"]/b[2]/following-sibling::text()[1]',
+    'Median condo value in 2022': '//*[@id="median-income"]/b[7]/following-sibling::text()[1]',
+    'Median condo value in 2000': '//*[@id="median-income"]/b[8]/following-sibling::text()[1]',
+    'Median contract rent': '//*[@id="median-rent"]/p/text()',
+    'Poverty percentage': '//*[@id="poverty-level"]/b[1]/following-sibling::text()[1]',
+    'Largest ethnicity percentage': '//*[@id="races-graph"]/div/ul/li[2]/ul/li[1]/span[2]/text()',
+    'Largest ethnicity slice': '//*[@id="races-graph"]/div/ul/li[2]/ul/li[1]/b/text()',
+    'Most recent crime index': '//*[@id="crimeTab"]/tfoot/tr/td[last()]//text()',
+    'Unemployment rate': '//*[@id="unemployment"]/div[1]/table/tr[1]/td[2]/text()'
+}
+
+city_field_types = {
+    'Population in 2022': 'count',
+    'Population change since 2000 (%)': 'percent',
+    'Median household income in 2022': 'currency',
+    'Median household income in 2000': 'currency',
+    'Median condo value in 2022': 'currency',
+    'Median condo value in 2000': 'currency',
+    'Median contract rent': 'currency',
+    'Poverty percentage': 'percent',
+    'Largest ethnicity percentage': 'percent',
+    'Largest ethnicity slice': 'text',
+    'Most recent crime index': 'number',
+    'Unemployment rate': 'percent'
+}
+
+# States analyzed when none are given on the command line
+STATES_TO_ANALYZE = [
+    'North Carolina', 'Alabama', 'Georgia'
+]
+
+# Specify the minimum population for inclusion
+MIN_POPULATION = 50000
+
+def get_state_file_name(state):
+    return state.replace(' ', '').lower()
+
+# Spreadsheet columns, in order
+def get_columns():
+    return ['City', 'Closest Metro Area', *city_fields, 'Job Growth (%)']
+
+# Completed rows are appended to checkpoints/<run id>/<state>.jsonl as soon as each city is
+# scraped, one {"city": ..., "row": {...}, "scraped_at": <unix time>} record per line
+CHECKPOINT_DIR = 'checkpoints'
+
+def get_checkpoint_path(output_dir, run_id, state):
+    return os.path.join(output_dir, CHECKPOINT_DIR, run_id, f"{get_state_file_name(state)}.jsonl")
+
+# The date a run was started ('YYYY-MM-DD'), kept in checkpoints/<run id>/run.json, so a run
+# resumed on a later day still writes its dataset partition under the day it started
+def start_run(output_dir, run_id, resume=False):
+    path = os.path.join(output_dir, CHECKPOINT_DIR, run_id, 'run.json')
+    if resume:
+        try:
+            with open(path, 'r') as json_file:
+                return json.load(json_file)['run_date']
+        except (OSError, ValueError, KeyError):
+            pass
+    run_date = datetime.now().strftime('%Y-%m-%d')
+    write_file_atomic(os.path.abspath(path), json.dumps({'run_id': run_id, 'run_date': run_date}).encode())
+    return run_date
+
+# Yields the records of a checkpoint file, skipping a line left half written by a crash
+def read_checkpoint(path):
+    if not os.path.exists(path):
+        return
+    with open(path, 'r') as checkpoint_file:
+        for line in checkpoint_file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                pass
+
+# Appends rows to a checkpoint file and flushes them to disk. Safe to call from worker threads.
+class CheckpointWriter:
+    def __init__(self, path, resume=False):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.completed = {record['city'] for record in read_checkpoint(path)} if resume else set()
+        self.lock = threading.Lock()
+        self.file = open(path, 'a' if resume else 'w')
+        # Terminate a line left half written by a crash before appending to it
+        if resume and self.file.tell() > 0:
+            with open(path, 'rb') as checkpoint_file:
+                checkpoint_file.seek(-1, os.SEEK_END)
+                if checkpoint_file.read(1) != b'\n':
+                    self.file.write('\n')
+
+    def write(self, city, row, scraped_at=None):
+        self.write_many([{'city': city, 'row': row, 'scraped_at': scraped_at or time.time()}])
+
+    # Append many records with a single fsync
+    def write_many(self, records):
+        lines = ''.join(json.dumps(record) + '\n' for record in records)
+        with self.lock:
+            self.file.write(lines)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.completed.update(record['city'] for record in records)
+
+    def close(self):
+        self.file.close()
+
+# A city that can't be fetched counts as failed like a non-200 response, so the rest of the
+# run still produces its outputs
+def scrape_city_to_checkpoint(checkpoint, city, state, city_fields, closest_metro_area, job_data, max_age=None):
+    import requests
+
+    with metrics.timer('city_seconds'):
+        try:
+            row = scrape_city(city, state, city_fields, closest_metro_area, job_data, max_age)
+        except requests.RequestException as e:
+            log(logging.WARNING, f"Failed to scrape {city}, {state}: {e}", event='city_failed', city=city, state=state)
+            row = None
+    metrics.increment('cities_total', result='scraped' if row else 'failed')
+    if row:
+        checkpoint.write(city, row)
+    return row is not None
+
+# Incremental refresh: a city is carried over from the newest earlier checkpoint of its state
+# unless it is new in the state index, its population changed since the last population
+# snapshot, or it was scraped more than max_age_days ago
+REFRESH_MAX_AGE_DAYS = 30
+
+# Newest checkpoint of a state over all runs in output_dir, or None
+def find_latest_checkpoint(output_dir, state, exclude_run_id=None):
+    checkpoint_dir = os.path.join(output_dir, CHECKPOINT_DIR)
+    if not os.path.isdir(checkpoint_dir):
+        return None
+    paths = [get_checkpoint_path(output_dir, run_id, state) for run_id in os.listdir(checkpoint_dir) if run_id != exclude_run_id]
+    return max((path for path in paths if os.path.exists(path)), key=os.path.getmtime, default=None)
+
+# Returns {city: record} of a checkpoint. Records written before scraped_at was recorded get
+# the modification time of the file.
+def load_checkpoint_records(path):
+    if not path:
+        return {}
+    modified_at = os.path.getmtime(path)
+    records = {}
+    for record in read_checkpoint(path):
+        record.setdefault('scraped_at', modified_at)
+        records[record['city']] = record
+    return records
+
+# Returns the {city: population} of a saved state index, or {} when there is none
+def load_population_snapshot(path):
+    try:
+        with open(path, 'r') as json_file:
+            return json.load(json_file) or {}
+    except (OSError, ValueError):
+        return {}
+
+# Split the cities of a state index into the cities to scrape again and the previous records
+# to carry over. Returns (cities to scrape, {city: record}, {reason: number of cities}).
+def plan_refresh(cities_data, previous_populations, previous_records, max_age_days=REFRESH_MAX_AGE_DAYS, now=None):
+    now = now or time.time()
+    cities_to_scrape = []
+    carried = {}
+    counts = {'new': 0, 'changed': 0, 'stale': 0, 'unchanged': 0}
+    for city, population in cities_data.items():
+        record = previous_records.get(city)
+        if record is None:
+            reason = 'new'
+        elif previous_populations.get(city, population) != population:
+            reason = 'changed'
+        elif now - record['scraped_at'] > max_age_days * 24 * 3600:
+            reason = 'stale'
+        else:
+            reason = 'unchanged'
+        counts[reason] += 1
+        if reason == 'unchanged':
+            carried[city] = record
+        else:
+            cities_to_scrape.append(city)
+    return cities_to_scrape, carried, counts
+
+# Scrape every city above min_population in the given states. All cities of all states share
+# one worker pool, so the fetch budget is spread across states. Rows are streamed to one
+# checkpoint file per state; with resume, cities already in the checkpoint of the same
+# run_id are skipped. With refresh only new, changed and stale cities are scraped (see
+# plan_refresh()), the other rows are copied from the newest earlier checkpoint with their
+# job growth updated, and stored BLS job data is reused while it is current.
+# Returns {state: checkpoint path} for the states that have at least one row.
+def scrape_states(states, min_population, output_dir='.', run_id=None, resume=False, refresh=False, max_age_days=REFRESH_MAX_AGE_DAYS):
+    run_id = run_id or datetime.now().strftime('%Y-%m-%d')
+    population_dir = os.path.join(output_dir, 'populations')
+    os.makedirs(population_dir, exist_ok=True)
+    # A refresh revalidates the state indexes and the pages it scrapes again with the server
+    # instead of using cached copies
+    max_age = 0 if refresh else None
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Fetch every state index page concurrently
+        with metrics.timer('stage_seconds', stage='state_index'):
+            state_urls = [f"{CITY_DATA_URL}{state.replace(' ', '-')}.html" for state in states]
+            all_cities_data = executor.map(scrape_cities, state_urls, states, repeat(min_population), repeat(max_age))
+
+            checkpoint_paths = {}
+            completed = {}
+            cities_by_state = {}
+            carried_by_state = {}
+            snapshots = {}
+            for state, cities_data in zip(states, all_cities_data):
+                population_path = os.path.join(population_dir, f"{get_state_file_name(state)}_cities_population.json")
+                cities_to_scrape = list(cities_data or {})
+                if refresh:
+                    # The checkpoint of this run may be the newest, it is only rewritten in the cities stage
+                    previous_records = load_checkpoint_records(find_latest_checkpoint(output_dir, state, run_id if resume else None))
+                    if cities_data is None:
+                        log(logging.WARNING, f"Keeping the previous rows of {state}, its state index could not be fetched",
+                            event='refresh_index_failed', state=state)
+                        carried_by_state[state] = previous_records
                     else:
-                        data['Job Growth (%)'].append(None)
-                        data['Closest Metro Area'].append(None)
-                else:
-                    data['Job Growth (%)'].append(None)
-                    data['Closest Metro Area'].append(None)
+                        cities_to_scrape, carried_by_state[state], counts = plan_refresh(
+                            cities_data, load_population_snapshot(population_path), previous_records, max_age_days)
+                        log(logging.INFO, f"Refreshing {state}: {counts['new']} new, {counts['changed']} changed, "
+                            f"{counts['stale']} stale, {counts['unchanged']} unchanged cities", event='refresh', state=state, **counts)
+
+                # Saved once the cities of the state are scraped, so a run that fails before
+                # keeps the changed cities of a refresh
+                if cities_data is not None or not refresh:
+                    snapshots[state] = (population_path, cities_data)
+
+                checkpoint_paths[state] = get_checkpoint_path(output_dir, run_id, state)
+                completed[state] = {record['city'] for record in read_checkpoint(checkpoint_paths[state])} if resume else set()
+                cities_by_state[state] = [city for city in cities_to_scrape if city not in completed[state]]
+                if completed[state]:
+                    metrics.increment('cities_total', len(completed[state]), result='skipped')
+                    log(logging.INFO, f"Resuming {state}: {len(completed[state])} cities already scraped",
+                        event='resume', state=state, completed=len(completed[state]))
+
+        # Geocode every city of the run up front, then resolve the closest metro area of every
+        # city and fetch each unique BLS series once
+        with metrics.timer('stage_seconds', stage='geocode'):
+            coordinates = geocode_cities(f"{city}, {state_initials[state]}" for state, cities_to_analyze in cities_by_state.items() for city in cities_to_analyze)
+
+        with metrics.timer('stage_seconds', stage='metro_area'):
+            closest_metro_areas = {}
+            series_ids = {}
+            for state, cities_to_analyze in cities_by_state.items():
+                city_names = {city: f"{city}, {state_initials[state]}" for city in cities_to_analyze}
+                closest_by_name = find_closest_metro_areas(city_names.values(), coordinates=coordinates)
+                for city, city_name in city_names.items():
+                    closest_metro_area = closest_by_name[city_name]
+                    closest_metro_areas[(state, city)] = closest_metro_area
+                    if closest_metro_area:
+                        series_ids[(state, city)] = construct_bls_series_id(state, get_metro_index().get_area_code(closest_metro_area))
+            for state, carried in carried_by_state.items():
+                for city, record in carried.items():
+                    area_code = get_metro_index().get_area_code(record['row'].get('Closest Metro Area'))
+                    if area_code:
+                        series_ids[(state, city)] = construct_bls_series_id(state, area_code)
+
+        # The job data is saved to bls_series.json by run() once every process is done
+        with metrics.timer('stage_seconds', stage='bls'):
+            if refresh:
+                reuse_bls_series(load_bls_series(os.path.join(output_dir, BLS_SERIES_FILE)))
+            job_data_by_series = fetch_bls_series(series_ids.values())
+
+        # Open the checkpoints only now, so a failed earlier stage leaves the previous rows of a
+        # same day refresh in place. Copy the carried over rows with their job growth updated
+        # first, then queue the cities of every state at once.
+        with metrics.timer('stage_seconds', stage='cities'):
+            checkpoints = {state: CheckpointWriter(path, resume) for state, path in checkpoint_paths.items()}
+            for state, carried in carried_by_state.items():
+                records = []
+                for city, record in carried.items():
+                    if city in checkpoints[state].completed:
+                        continue
+                    row = dict(record['row'])
+                    job_data = job_data_by_series.get(series_ids.get((state, city)))
+                    if job_data:
+                        row['Job Growth (%)'] = calculate_job_growth(job_data['most_recent_value'], job_data['previous_year_value'])
+                    records.append({'city': city, 'row': row, 'scraped_at': record['scraped_at']})
+                checkpoints[state].write_many(records)
+                metrics.increment('cities_total', len(records), result='carried')
+
+            futures = {
+                state: [
+                    executor.submit(scrape_city_to_checkpoint, checkpoints[state], city, state, city_fields,
+                                    closest_metro_areas[(state, city)], job_data_by_series.get(series_ids.get((state, city))), max_age)
+                    for city in cities_to_analyze
+                ]
+                for state, cities_to_analyze in cities_by_state.items()
+            }
+
+            results = {}
+            for state, state_futures in futures.items():
+                for future in state_futures:
+                    future.result()
+                checkpoints[state].close()
+                if state in snapshots:
+                    population_path, cities_data = snapshots[state]
+                    with open(population_path, "w") as outfile:
+                        json.dump(cities_data, outfile, indent=4)
+                if checkpoints[state].completed:
+                    log(logging.INFO, f"Scraping complete for state of {state}", event='state_complete', state=state,
+                        cities=len(checkpoints[state].completed))
+                    results[state] = checkpoints[state].file.name
+
+    return results
+
+# Process pool entry point. Runs in a fresh interpreter, so the fetch, cache and logging settings
+# of the parent are passed in explicitly. The per-host rate limits are divided between the
+# processes. Returns the checkpoint paths, the metrics and the BLS job data of the process.
+def scrape_states_in_process(states, min_population, output_dir, run_id, resume, refresh, max_age_days, max_workers, rate_limits,
+                             cache_only, log_format, log_level):
+    # A pool worker can run more than one task, only return the metrics of this one
+    metrics.reset()
+    configure_logging(log_format, log_level)
+    configure_fetcher(max_workers=max_workers, rate_limits=rate_limits)
+    configure_cache(cache_only=cache_only)
+    checkpoint_paths = scrape_states(states, min_population, output_dir, run_id, resume, refresh, max_age_days)
+    with bls_series_lock:
+        job_data_by_series = dict(bls_series_data)
+    return checkpoint_paths, metrics.to_dict(), job_data_by_series
+
+# Write the rows of one or more checkpoint files ({state: path}) to a spreadsheet. Rows are
+# streamed, so memory use does not grow with the number of cities. With include_state a
+# leading State column is added.
+def save_checkpoints_to_spreadsheet(checkpoint_paths, filename, include_state=False):
+    from openpyxl import Workbook
+
+    columns = get_columns()
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append((['State'] if include_state else []) + columns)
+    for state, path in checkpoint_paths.items():
+        for record in read_checkpoint(path):
+            sheet.append(([state] if include_state else []) + [record['row'].get(column) for column in columns])
+    workbook.save(filename)
+    log(logging.INFO, f"Data saved to {filename}", event='saved', path=filename)
+
+# Columnar dataset of all runs: one Parquet file per state and run date, stored as
+# dataset/state=<state>/run_date=<YYYY-MM-DD>/part-0.parquet so readers can prune by
+# partition. Every file has the same column types, derived from city_field_types.
+DATASET_DIR = 'dataset'
+
+dataset_value_types = {
+    'count': 'Int64',
+    'currency': 'float64',
+    'percent': 'float64',
+    'number': 'float64',
+    'text': 'string',
+    'auto': 'string',
+}
+
+def get_dataset_column_types():
+    column_types = {
+        'City': 'string',
+        'Closest Metro Area': 'string'
+    }
+    for field in city_fields:
+        column_types[field] = dataset_value_types[city_field_types.get(field, 'auto')]
+    column_types['Job Growth (%)'] = 'float64'
+    return column_types
+
+# Build a dataset frame with the stable column types from a list of row dicts
+def build_dataset_frame(rows):
+    import pandas as pd
+
+    df = pd.DataFrame.from_records(rows, columns=get_columns())
+    for column, column_type in get_dataset_column_types().items():
+        if column_type == 'string':
+            df[column] = df[column].map(lambda value: None if value is None else str(value)).astype('string')
+        else:
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype(column_type)
+    return df
+
+# Write the rows of a state's checkpoint to its partition of the dataset, replacing the
+# partition if the state was already written for the same run date
+def save_checkpoint_to_dataset(checkpoint_path, state, run_date, dataset_dir=DATASET_DIR):
+    partition_dir = os.path.join(dataset_dir, f"state={state}", f"run_date={run_date}")
+    os.makedirs(partition_dir, exist_ok=True)
+    df = build_dataset_frame([record['row'] for record in read_checkpoint(checkpoint_path)])
+    filename = os.path.join(partition_dir, 'part-0.parquet')
+    df.to_parquet(filename, index=False)
+    log(logging.INFO, f"Data saved to {filename}", event='saved', path=filename)
+
+# Read the dataset back, optionally only some columns, states and run dates. The state and
+# run_date partition columns are always included.
+def load_dataset(dataset_dir=DATASET_DIR, columns=None, states=None, run_dates=None):
+    import pandas as pd
 
-        if data['City']:
-            print(f"Scraping complete for state of {state}")
-            filename = f'scraped_population_and_job_data_{state.replace(' ', '').lower()}.xlsx'
-            save_to_spreadsheet(data, filename)
+    filters = []
+    if states:
+        filters.append(('state', 'in', list(states)))
+    if run_dates:
+        filters.append(('run_date', 'in', list(run_dates)))
+    if columns:
+        columns = list(dict.fromkeys([*columns, 'state', 'run_date']))
+    df = pd.read_parquet(dataset_dir, columns=columns, filters=filters or None)
+    for column in ('state', 'run_date'):
+        df[column] = df[column].astype('string')
+    return df
+
+# Export (part of) the dataset to a spreadsheet
+def save_dataset_to_spreadsheet(filename, dataset_dir=DATASET_DIR, columns=None, states=None, run_dates=None):
+    df = load_dataset(dataset_dir, columns, states, run_dates)
+    df.to_excel(filename, index=False)
+    log(logging.INFO, f"Data saved to {filename}", event='saved', path=filename)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Scrape city-data.com and BLS job growth for the cities of one or more states.')
+    parser.add_argument('states', nargs='*', default=STATES_TO_ANALYZE,
+                        help='States to analyze, eg. "North Carolina" Alabama (default: %(default)s)')
+    parser.add_argument('--all-states', action='store_true', help='Analyze all 50 states')
+    parser.add_argument('--min-population', type=int, default=MIN_POPULATION,
+                        help='Minimum city population for inclusion (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS,
+                        help='Concurrent requests per process (default: %(default)s)')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Processes to spread the states over, sharing the per-host rate limits (default: %(default)s)')
+    parser.add_argument('--output-dir', default='.', help='Directory for the spreadsheets and population files (default: %(default)s)')
+    parser.add_argument('--cache-only', action='store_true', help='Only use cached responses, never touch the network')
+    parser.add_argument('--run-id', default=datetime.now().strftime('%Y-%m-%d'),
+                        help='Name of the run, used for its checkpoint files (default: today, %(default)s)')
+    parser.add_argument('--resume', action='store_true', help='Skip cities already scraped by an earlier attempt of the same run')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Only scrape cities that are new, changed population or are older than --max-age, and reuse current BLS data')
+    parser.add_argument('--max-age', type=float, default=REFRESH_MAX_AGE_DAYS, metavar='DAYS',
+                        help='With --refresh, scrape cities again after this many days (default: %(default)s)')
+    parser.add_argument('--output-format', choices=['both', 'parquet', 'excel'], default='both',
+                        help='Write the Parquet dataset, the Excel spreadsheets or both (default: %(default)s)')
+    parser.add_argument('--dataset-dir', help=f'Directory of the Parquet dataset (default: <output dir>/{DATASET_DIR})')
+    parser.add_argument('--log-format', choices=['text', 'json'], default='text', help='Log as plain text or one JSON object per line (default: %(default)s)')
+    parser.add_argument('--verbose', action='store_true', help='Also log every HTTP request')
+    parser.add_argument('--metrics-file', help='Where to write the run metrics, Prometheus text if it ends in .prom and JSON otherwise (default: <output dir>/metrics.json)')
+    parser.add_argument('--profile', metavar='FILE', help='Profile the run with cProfile and save the stats to FILE')
+    args = parser.parse_args(argv)
+
+    if args.all_states:
+        args.states = list(state_initials)
+    unknown_states = [state for state in args.states if state not in state_initials]
+    if unknown_states:
+        parser.error(f"Unknown state(s): {', '.join(unknown_states)}")
+    args.states = list(dict.fromkeys(args.states))
+    # Fail before scraping rather than after it when the dataset can't be written
+    if args.output_format in ('both', 'parquet') and importlib.util.find_spec('pyarrow') is None:
+        parser.error(f"--output-format {args.output_format} writes a Parquet dataset, which needs pyarrow "
+                     "(pip install pyarrow). Use --output-format excel to only write the spreadsheets.")
+    return args
+
+def run(args):
+    run_date = start_run(args.output_dir, args.run_id, args.resume)
+    processes = max(1, min(args.processes, len(args.states)))
+    if processes == 1:
+        checkpoint_paths = scrape_states(args.states, args.min_population, args.output_dir, args.run_id, args.resume,
+                                         args.refresh, args.max_age)
+        with bls_series_lock:
+            job_data_by_series = dict(bls_series_data)
+    else:
+        rate_limits = {host: rate / processes for host, rate in HOST_RATE_LIMITS.items()}
+        checkpoint_paths = {}
+        job_data_by_series = {}
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [
+                executor.submit(scrape_states_in_process, args.states[i::processes], args.min_population, args.output_dir,
+                                args.run_id, args.resume, args.refresh, args.max_age, args.workers, rate_limits, args.cache_only,
+                                args.log_format, logger.level)
+                for i in range(processes)
+            ]
+            for future in futures:
+                process_checkpoint_paths, process_metrics, process_job_data = future.result()
+                checkpoint_paths.update(process_checkpoint_paths)
+                metrics.merge(process_metrics)
+                job_data_by_series.update(process_job_data)
+    # Saved by the parent only, so the processes don't overwrite each other's series
+    update_bls_series(os.path.join(args.output_dir, BLS_SERIES_FILE), job_data_by_series)
+
+    # Assemble the outputs from the checkpoints, in the order the states were given. The
+    # spreadsheets come first, so they are written even if the dataset can't be.
+    checkpoint_paths = {state: checkpoint_paths[state] for state in args.states if state in checkpoint_paths}
+    if args.output_format in ('both', 'excel'):
+        with metrics.timer('stage_seconds', stage='excel'):
+            for state, path in checkpoint_paths.items():
+                filename = os.path.join(args.output_dir, f"scraped_population_and_job_data_{get_state_file_name(state)}.xlsx")
+                save_checkpoints_to_spreadsheet({state: path}, filename)
+
+            if len(checkpoint_paths) > 1:
+                save_checkpoints_to_spreadsheet(checkpoint_paths, os.path.join(args.output_dir, 'scraped_population_and_job_data_all.xlsx'), include_state=True)
+
+    if args.output_format in ('both', 'parquet'):
+        with metrics.timer('stage_seconds', stage='dataset'):
+            dataset_dir = args.dataset_dir or os.path.join(args.output_dir, DATASET_DIR)
+            for state, path in checkpoint_paths.items():
+                save_checkpoint_to_dataset(path, state, run_date, dataset_dir)
+
+# Log the time spent per stage and the slowest functions of a profile
+def log_run_summary(profiler=None):
+    for histogram in metrics.to_dict()['histograms']:
+        if histogram['name'] == 'stage_seconds':
+            stage = histogram['labels']['stage']
+            log(logging.INFO, f"Stage {stage}: {histogram['sum']:.2f}s", event='stage_summary', stage=stage, seconds=round(histogram['sum'], 4))
+    if profiler:
+        import pstats
+
+        stats_output = io.StringIO()
+        pstats.Stats(profiler, stream=stats_output).sort_stats('cumulative').print_stats(20)
+        log(logging.INFO, stats_output.getvalue(), event='profile')
+
+# Main function
+def main(argv=None):
+    args = parse_args(argv)
+    configure_logging(args.log_format, logging.DEBUG if args.verbose else logging.INFO)
+    os.makedirs(args.output_dir, exist_ok=True)
+    configure_fetcher(max_workers=args.workers)
+    configure_cache(cache_only=args.cache_only)
+    metrics.reset()
+
+    profiler = None
+    if args.profile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with metrics.timer('run_seconds'):
+            run(args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            log(logging.INFO, f"Profile saved to {args.profile}", event='saved', path=args.profile)
+        metrics_file = args.metrics_file or os.path.join(args.output_dir, 'metrics.json')
+        metrics.save(metrics_file)
+        log_run_summary(profiler)
+        log(logging.INFO, f"Metrics saved to {metrics_file}", event='saved', path=metrics_file)
 
-    print("Scraping complete for all states")
+    log(logging.INFO, "Scraping complete for all states", event='run_complete')
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()